@@ -7,11 +7,108 @@ import time
 import cairo
 import math 
 import sys
+import os
+import threading
+import io
+import hashlib
+import shutil
 import argparse 
-from statistics import mean
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 __authors__ = ["Bruce (Shidi) Xi", "Sunny Leung"]
 
+pixel_grey = 0xFF808080 # Grey and black as cairo RGB24 pixels (the top byte is unused), used to draw the rectangles with numpy. 
+pixel_black = 0xFF000000
+scene_version = 3 # Part of the scene cache key, bump it whenever the way scenes are drawn changes so that old cached scenes are not reused. 
+
+# Control how fine (high detail) the background is. The tile is a fineness x fineness white square with a black square covering 75% of its sides in the top left corner. 
+# It is returned as RGB24 pixels, an array of shape (fineness, fineness, 4). 
+# When 75% of fineness is not a whole number, the pixels on the edge of the black square are grey in proportion to how much of them it covers, the same as cairo would draw them. 
+def make_tile (fineness):
+    edge = np.clip(fineness*0.75 - np.arange(fineness), 0, 1) # How much of each pixel row/column the black square covers. 
+    coverage = np.outer(edge, edge)
+    tile = np.empty((fineness, fineness, 4), dtype=np.uint8)
+    tile[:, :, :3] = np.round(255*(1 - coverage)).astype(np.uint8)[:, :, None]
+    tile[:, :, 3] = 255
+    return tile
+
+# The part of a scene that is the same in every frame: the checkerboard background and the low detail rectangles. 
+# Arguments are the same as in Datapath.make_scene. 
+def make_background (length, height, fineness, rect1, rect2):
+    tile = make_tile(fineness).view(np.uint32)[:, :, 0] # One RGB24 pixel per 4 bytes. 
+    reps_y = -(-height//fineness) # Enough tiles to cover the canvas, the extra part is cut off below. 
+    reps_x = -(-length//fineness)
+    background = np.tile(tile, (reps_y, reps_x))[:height, :length]
+
+    def draw_rect (rect_info): # Draw the low detail rectangle on the background. 
+        x0 = max(int(round(rect_info['x'])), 0)
+        y0 = max(int(round(rect_info['y'])), 0)
+        x1 = int(round(rect_info['x'] + rect_info['length']))
+        y1 = int(round(rect_info['y'] + rect_info['height']))
+        background[y0:y1, x0:x1] = pixel_grey
+
+    draw_rect (rect1)
+    draw_rect (rect2) # Draw two rectangles as a control of the low level detail.
+    return background
+
+# Frames are rendered in worker processes. Each worker builds the background once when it starts and reuses it for all the frames it renders. 
+_background = None
+
+def init_frame_worker (length, height, fineness, rect1, rect2):
+    global _background
+    _background = make_background(length, height, fineness, rect1, rect2)
+
+# The footprint of the motion object rotated theta degrees around its center, which is also the center of the scene. 
+# Returns (x0, y0, mask): mask is a boolean array of the pixels covered by the object within its bounding box, whose top left corner is at (x0, y0). 
+# A pixel is covered when its center is inside the rotated rectangle. 
+def make_motion_mask (length, height, mo_size, mo_size_y, theta):
+    mo_ctr_x = length/2 # Center of the rotating motion object. 
+    mo_ctr_y = height/2
+    theta = theta*math.pi/180 # Angle of rotation in radians 
+    cos_t = math.cos(theta)
+    sin_t = math.sin(theta)
+    half_w = (abs(mo_size*cos_t) + abs(mo_size_y*sin_t))/2 # Half of the bounding box of the rotated object. 
+    half_h = (abs(mo_size*sin_t) + abs(mo_size_y*cos_t))/2
+    x0 = max(int(math.floor(mo_ctr_x - half_w)), 0)
+    y0 = max(int(math.floor(mo_ctr_y - half_h)), 0)
+    x1 = min(int(math.ceil(mo_ctr_x + half_w)), length)
+    y1 = min(int(math.ceil(mo_ctr_y + half_h)), height)
+
+    xs = (np.arange(x0, x1) + 0.5 - mo_ctr_x)[None, :]
+    ys = (np.arange(y0, y1) + 0.5 - mo_ctr_y)[:, None] # Pixel centers relative to the center of rotation. 
+    u = xs*cos_t + ys*sin_t
+    v = ys*cos_t - xs*sin_t # Rotated back by theta, into the frame of the unrotated rectangle. 
+    mask = (np.abs(u) <= mo_size/2) & (np.abs(v) <= mo_size_y/2)
+    return x0, y0, mask
+
+# Render one frame as png bytes, with the motion object stamped on the background. 
+# The argument is one footprint of the motion object as returned by make_motion_mask. 
+def render_frame (motion_mask):
+    x0, y0, mask = motion_mask
+    height, length = _background.shape
+    frame = _background.copy()
+    frame[y0:y0+mask.shape[0], x0:x0+mask.shape[1]][mask] = pixel_black # Draw the motion object. 
+
+    stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_RGB24, length)
+    surf = cairo.ImageSurface.create_for_data(frame, cairo.FORMAT_RGB24, length, height, stride)
+    png = io.BytesIO()
+    surf.write_to_png(png)
+    return png.getvalue()
+
+# Return the rtsp option that sets the socket timeout for the installed ffmpeg.
+# It is "-timeout" from ffmpeg 5 on, but "-stimeout" before that, where "-timeout" makes ffmpeg listen for an incoming connection instead.
+# Builds from git report no release number ("ffmpeg version N-..."), they are taken as recent.
+def rtsp_timeout_option ():
+    output = subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True).stdout
+    version = re.match(rb'ffmpeg version n?(\d+)\.', output)
+    if version is not None and int(version.group(1)) < 5:
+        return '-stimeout'
+    return '-timeout'
+
+motion_pattern = re.compile(r'30s:\s(\d+)\spercent') # Motion score in the output of 'ms' in daemonapp. 
+detail_pattern = re.compile(rb'HighDetail:\s(\d+)%.*?LowDetail:\s(\d+)%', re.DOTALL) # Scores in the output of detail.exe. 
+
 # The Datapath class consists methods to produce and evaluate a scene. An engineer can manually invoke methods from this class to make qualified scenes. 
 # A Controller class which will be defined later can mimic the behaviours of a human engineer to produce qualified scenes automatically, using the methods defined in Datapath. 
 # Arguments:
@@ -32,6 +129,44 @@ class Datapath:
         self.camera = Camera(username=self.username, password=self.password, hostip=self.ip)
         self.camera.avigilon_client.execute_console_cmd('dev')
         self.camera.avigilon_client.execute_console_cmd('sys.motiondetectionalgo') # Create the camera object in "daemonapp".
+        self.player = None # The ffplay process playing the scene. 
+        self.motion_masks = None # The footprints of the motion object in the last scene made, and the parameters they were made for. 
+        self.timeout_option = rtsp_timeout_option()
+        self.captured = False # Whether "test.png" holds a frame captured in this run. 
+        self.start_stream()
+
+    def __del__ (self):
+        for process in (getattr(self, 'stream', None), getattr(self, 'player', None)):
+            if process is not None and process.poll() is None:
+                process.kill()
+
+    # This method opens the camera's rtsp streaming once and keeps it open, ffmpeg writes the decoded frames to its stdout as raw pixels.
+    # Only 2 frames per second are kept, which is plenty for captures and keeps the pipe, and how stale a captured frame can be, small. 
+    # The first video stream is mapped explicitly, the same one ffprobe reads the size of, so the frame size always matches when the camera offers several streams. 
+    # The pixels are in the same layout as a cairo RGB24 surface, so a frame can be saved as png without converting it. 
+    # A background thread keeps reading the frames into a small ring so that the latest one is always at hand, and ffmpeg never waits on a full pipe. 
+    # The rtsp socket timeout (in microseconds, see rtsp_timeout_option) makes ffmpeg give up on a camera that stops answering instead of waiting on the socket forever. 
+    # ffprobe is run directly rather than through ffmpeg.probe, whose own timeout argument would take the place of the rtsp option. 
+    def start_stream (self):
+        cmd = ['ffprobe', '-v', 'error', '-rtsp_transport', 'tcp', self.timeout_option, '10000000', '-select_streams', 'v:0', '-show_entries', 'stream=width,height', '-of', 'csv=p=0:s=x', self.rtsp]
+        output = subprocess.run(cmd, capture_output=True, check=True, timeout=20).stdout # Size of the video, e.g. b"1920x1080". 
+        width, height = output.decode().strip().split('x')
+        self.stream_width = int(width)
+        self.stream_height = int(height)
+        cmd = ['ffmpeg', '-rtsp_transport', 'tcp', '-loglevel', 'error', self.timeout_option, '10000000', '-i', self.rtsp, '-map', '0:v:0', '-vf', 'fps=2', '-f', 'rawvideo', '-pix_fmt', 'bgr0', '-']
+        self.stream = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        self.latest_frames = deque(maxlen=2)
+        self.frame_ready = threading.Event() # Set every time a new frame is read from the stream. 
+        threading.Thread(target=self.read_stream, args=(self.stream, self.latest_frames, self.frame_ready, self.stream_width*self.stream_height*4), daemon=True).start()
+
+    # Each reader thread only touches the ffmpeg process, ring and event it was started with, so a thread left over from before a restart never mixes with the new stream. 
+    def read_stream (self, stream, latest_frames, frame_ready, frame_size):
+        while True:
+            frame = stream.stdout.read(frame_size)
+            if len(frame) < frame_size: # ffmpeg has exited. 
+                break
+            latest_frames.append(frame)
+            frame_ready.set()
          
     # Unused argparse method, put here for potential future use. 
     def arg(self):
@@ -45,25 +180,39 @@ class Datapath:
 
     # This method captures a frame from the camera's streaming using the rtsp provided.
     # It then save the captured frame into the provided filepath and name it "test.png". 
-    def capture_frames (self):  
-        cmd = 'ffmpeg -rtsp_transport tcp -loglevel error -i {} -y {}\\test.png'.format(self.rtsp, self.filepath)
-        subprocess.run(cmd)
+    # The frame is the first one that arrives from the stream after this method is called. 
+    # If no frame arrives within timeout seconds, the stream is restarted, since ffmpeg may hang on a camera that stopped sending without exiting. 
+    # Returns True if "test.png" now holds a new frame, False if the camera gave nothing. 
+    def capture_frames (self, timeout = 15):  
+        self.frame_ready.clear()
+        if not self.frame_ready.wait(timeout):
+            print(f"Warning: no frame from the camera in {timeout} seconds, restarting the rtsp stream.")
+            if self.stream.poll() is None:
+                self.stream.kill()
+            try:
+                self.start_stream()
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+                print("Cannot reach the rtsp stream, will try again on the next capture.")
+            return False
+        frame = bytearray(self.latest_frames[-1]) # cairo needs a writable buffer. 
+        stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_RGB24, self.stream_width)
+        surf = cairo.ImageSurface.create_for_data(frame, cairo.FORMAT_RGB24, self.stream_width, self.stream_height, stride)
+        surf.write_to_png(self.filepath+"\\test.png")
+        self.captured = True
+        return True
  
     # This method run the "detail.exe" program to check the motion scores of "test.png",
     # The stdout is then feed back here to store the high and low detail scores.
     # "detail.exe" must be at the same directory as the script is run as well as "test.png" is stored. 
     # Or, you can modify the cmd below to include the absolute paths. 
     def check_detail (self): # This method run the detail.exe program by calling it in the terminal, and get the high detail score and the low detail score. 
-        cmd = 'detail "test.png"'
+        cmd = ['detail', 'test.png']
         try:
-            output = subprocess.Popen( cmd, stdout=subprocess.PIPE ).communicate()[0] # Run the detail.exe program and feed its terminal output back to python as a byte string.
-            output_str = output.decode("utf-8") # Change the bytes into string. 
-            m_high = re.search(r'HighDetail:[\s](\d+)%', output_str)
-            if m_high:
-                self.high_detail = int(m_high.group(1))
-            m_low = re.search(r'LowDetail:[\s](\d+)%', output_str)
-            if m_low:
-                self.low_detail = int(m_low.group(1)) # Extract high detail score and low detail score from output_str. 
+            output = subprocess.run(cmd, capture_output=True, check=True).stdout # Run the detail.exe program and feed its terminal output back to python as a byte string.
+            m = detail_pattern.search(output)
+            if m:
+                self.high_detail = int(m.group(1))
+                self.low_detail = int(m.group(2)) # Extract high detail score and low detail score from the output. 
         except FileNotFoundError:
             print("You are not running this script at the same directory as detail.exe")
             sys.exit()
@@ -71,25 +220,38 @@ class Datapath:
     # This method call "ms" in daemonapp to check for the motion score. 
     def check_motion (self):
         self.sample_range = 10 # We will collect this amount of data points for the motion score. 
-        self.motion_list = []
+        self.motion_list = deque(maxlen=self.sample_range) # Only the last N scores, where N == sample_range, are needed to tell if the score has settled. 
+        sample_count = 0
+        sample_total = 0 # Count and sum of all the scores, for the average when the score never settles. 
+        interval = 0.5 # Seconds to wait between two 'ms' calls. It starts short and backs off while the score is still changing. 
+        missed_replies = 0 # Replies in a row without a motion score. 
         while True: 
             daemon_output = self.camera.avigilon_client.execute_console_cmd('ms')['Output'] 
-            motion_detec = int(re.search (r'30s:\s(\d+)\spercent', daemon_output).group(1)) # Call 'ms' in daemonapp, get the motion detection score. 
-            self.motion_list.append(motion_detec) # Add the score into a list everytime we call 'ms'. 
-            print("motion detected: ", self.motion_list[-1])
-            time.sleep (3)
-            if (len(self.motion_list) < self.sample_range):
+            m = motion_pattern.search(daemon_output) # Call 'ms' in daemonapp, get the motion detection score. 
+            if not m:
+                missed_replies += 1
+                print("No motion score in the reply of 'ms': ", daemon_output)
+                if (missed_replies == 3):
+                    print("daemonapp keeps replying without a motion score, please check the camera.")
+                    sys.exit()
+                time.sleep (interval)
                 continue
-            elif (len(self.motion_list) == 20): # Sometimes the score never settles, it fluctuates between two numbers. If this happens, we terminate the collection after 20 steps. 
-                self.motion_score = int(mean(self.motion_list))
+            missed_replies = 0
+            motion_detec = int(m.group(1))
+            self.motion_list.append(motion_detec) # Add the score into the window everytime we call 'ms'. 
+            sample_count += 1
+            sample_total += motion_detec
+            print("motion detected: ", self.motion_list[-1])
+            if (sample_count == 20): # Sometimes the score never settles, it fluctuates between two numbers. If this happens, we terminate the collection after 20 steps. 
+                self.motion_score = int(sample_total/sample_count)
                 break
-            else: # Wait until we have engough data >= sample_range
-                data_set = np.array(self.motion_list[-self.sample_range:]) 
-                if (np.var(data_set) == 0): # Calculate the variance of the last N data points in the list, where N == sample_range. If variance == 0, i.e., all N data points are equal, then we can say the motion score has stabilized, the score is valid.
-                    self.motion_score = data_set[-1]  # Get the latest 'ms' reading as the valid motion score. 
+            elif (len(self.motion_list) == self.sample_range): # Wait until we have engough data >= sample_range
+                if (max(self.motion_list) == min(self.motion_list)): # If all N data points in the window are equal, then we can say the motion score has stabilized, the score is valid.
+                    self.motion_score = self.motion_list[-1]  # Get the latest 'ms' reading as the valid motion score. 
                     break # Once we have a valid score, we break the infinite loop. Othewise, keep calling 'ms' in daemonapp to get more motion scores.  
-                else:
-                    continue
+            if (len(self.motion_list) >= 2 and self.motion_list[-1] != self.motion_list[-2]): # The score is still moving, wait longer before the next call. 
+                interval = min(interval*2, 3)
+            time.sleep (interval)
 
     # This method makes the scenes. 
     # In a scene, there will be a motion object (rotating rectangle) that furfill the motion target.
@@ -103,91 +265,69 @@ class Datapath:
     # The name of the made scene. Default is "scene". 
     def make_scene (self, mo_size = 600, length = None, height = None, fineness = 6, rect1 = {'x':0, 'y':0, 'length':0, 'height':0}, rect2 = {'x':0, 'y':0, 'length':0, 'height':0}, name = 'scene'):
         self.mo_size_y = int(self.hor_res*0.1) # The width of the rotating rectangle.
-        color_grey = {'r':0.5, 'g':0.5, 'b':0.5}
-        color_black = {'r':0, 'g':0, 'b':0}
 
         if length is None:
             length = self.hor_res
         if height is None:
             height = self.ver_res
 
-        def make_frame (theta, label): # Output one frame in png, with the motion object rotated theta degrees around its center. 
-            def drawPattern(ctx): # Draw the background square pattern. 
-                ctx.move_to(0.0, 0.0)
-                ctx.line_to(0.0, 1.0)
-                ctx.line_to(1.0, 1.0)
-                ctx.line_to(1.0, 0.0)
-                ctx.line_to(0.0, 0.0)
-                ctx.set_source_rgb(1.0, 1.0, 1.0)
-                ctx.fill()
-                ctx.rectangle(0, 0, 0.75, 0.75)
-                ctx.set_source_rgb(0, 0, 0)
-                ctx.fill()
-
-            def draw_rect (rect_info, color): # Draw the low detail rectangle. 
-                context.rectangle (rect_info['x'], rect_info['y'], rect_info['length'], rect_info['height'])
-                context.set_source_rgb(color['r'], color['g'], color['b'])
-                context.fill()
-
-            mo_ctr_x = length/2 # Center of the rotating motion object. 
-            mo_ctr_y = height/2
-            mo_x = mo_ctr_x - mo_size/2 # Position of the motion object. 
-            mo_y = mo_ctr_y - self.mo_size_y/2
-            theta = theta*math.pi/180 # Angle of rotation in radians 
-
-            surf = cairo.ImageSurface(cairo.FORMAT_ARGB32, length, height)
-            context = cairo.Context(surf)
-
-            # Control how fine (high detail) the background is. 
-            patternSurf = cairo.ImageSurface(cairo.FORMAT_ARGB32, fineness, fineness)
-            patternCtx = cairo.Context(patternSurf)
-            patternCtx.scale(fineness, fineness)
-            drawPattern(patternCtx)
-            patternSurf.flush()
-
-            context.move_to(0.0, 0.0)
-            context.line_to(0.0, height)
-            context.line_to(length, height)
-            context.line_to(length, 0.0)
-            context.line_to(0.0, 0.0)
-            context.set_source_surface(patternSurf)
-            context.get_source().set_extend(cairo.Extend.REPEAT) # Fill the background with repeated square pattern. 
-            context.fill()
-
-            draw_rect (rect1, color_grey)
-            draw_rect (rect2, color_grey) # Draw two rectangles as a control of the low level detail.
- 
-            context.translate(mo_ctr_x, mo_ctr_y) 
-            context.rotate(theta)
-            context.translate(-mo_ctr_x, -mo_ctr_y)
-            mo_info = {'x':mo_x, 'y':mo_y, 'length':mo_size, 'height':self.mo_size_y}
-            draw_rect (mo_info, color_black) # Draw the motion object, with the center of rotation being its own center.
-
-            surf.write_to_png(self.filepath+"\\bw_frames\\"+label+".png")
-
-        # The rotating rectangle spins for 180 degrees to overlap with itself. 
-        for i in range (0, 181, 9): # Maybe add a new feature here to control the frame rate? Currantly, each frame the rectangle rotates for 9 degrees. Increasing this number will increase the speed of rotation.
-            make_frame(theta = i, label = str(int(i/9))) # Generate frames 
-        (
-            ffmpeg # Use ffmpeg to combine frames into a video 
-            .input(self.filepath+"\\bw_frames\\%d.png", framerate=50 )
-            .output(self.filepath+"\\bw_frames\\video.mp4", pix_fmt = "yuv420p", loglevel = "fatal")
-            .run(overwrite_output=True)
-        )
-        cmd = 'ffmpeg -t 03:00 -loglevel fatal -y -stream_loop 1000 -i "{}\\bw_frames\\video.mp4" -c copy "{}\\bw_frames\\{}.mp4"'.format(self.filepath, self.filepath, name)
-        subprocess.run(cmd) # Use ffmpeg to extend the video to 3 min.    
-
+        # Scenes made with the same parameters are identical, so every scene is cached under a hash of its parameters and only made once. 
+        # The name is left out of the hash, a named final scene reuses the scene made while tuning. 
+        key = hashlib.sha1(repr((scene_version, mo_size, length, height, fineness, self.mo_size_y, rect1, rect2)).encode()).hexdigest()
+        cache_dir = self.filepath+"\\bw_frames\\cache"
+        cached_video = cache_dir+"\\"+key+".mp4"
+        if not os.path.exists(cached_video):
+            os.makedirs(cache_dir, exist_ok=True)
+            # The rotating rectangle spins for 180 degrees to overlap with itself. Frames are independent of each other, so they are rendered in parallel. 
+            # Maybe add a new feature here to control the frame rate? Currantly, each frame the rectangle rotates for 9 degrees. Increasing this number will increase the speed of rotation.
+            mask_key = (length, height, mo_size, self.mo_size_y)
+            if (self.motion_masks is None or self.motion_masks[0] != mask_key): # The motion object stays the same while the rest of the scene is tuned, so its footprints are kept for the next scene. 
+                self.motion_masks = (mask_key, [make_motion_mask(length, height, mo_size, self.mo_size_y, i) for i in range (0, 181, 9)])
+            frames = self.motion_masks[1]
+            workers = min(len(frames), os.cpu_count() or 1) # No need for more workers than frames, each worker holds its own copy of the background. 
+            process = (
+                ffmpeg # Use ffmpeg to combine frames into a video. The frames are piped in, nothing is written to disk. The video is short, ffplay loops it when playing. 
+                .input('pipe:', format = "image2pipe", framerate=50)
+                .output(cache_dir+"\\"+key+".tmp.mp4", pix_fmt = "yuv420p", vcodec = "libx264", loglevel = "fatal")
+                .run_async(pipe_stdin=True, overwrite_output=True)
+            )
+            broken_pipe = False
+            try:
+                with ProcessPoolExecutor(max_workers=workers, initializer=init_frame_worker, initargs=(length, height, fineness, rect1, rect2)) as executor:
+                    for png in executor.map(render_frame, frames): # Frames come back in order. 
+                        process.stdin.write(png)
+            except BrokenPipeError: # ffmpeg has exited before taking all the frames. 
+                broken_pipe = True
+            finally:
+                try:
+                    process.stdin.close() # Flushing to an ffmpeg that has exited breaks the pipe again, which must not stop the wait below. 
+                except BrokenPipeError:
+                    broken_pipe = True
+                process.wait()
+            if broken_pipe or process.returncode != 0:
+                raise ffmpeg.Error('ffmpeg', None, None)
+            os.replace(cache_dir+"\\"+key+".tmp.mp4", cached_video) # Only a complete video ends up in the cache. 
+        shutil.copyfile(cached_video, self.filepath+f"\\bw_frames\\{name}.mp4")
+
+    # Play the scene in a loop. The scene that was playing before, if any, is stopped first. 
     def play_scene (self):
-        cmd = 'ffplay -fs -loglevel fatal -autoexit "{}\\bw_frames\\scene.mp4"'.format(self.filepath)
-        subprocess.Popen(cmd)
+        if self.player is not None and self.player.poll() is None:
+            self.player.kill()
+        cmd = ['ffplay', '-fs', '-loop', '0', '-loglevel', 'fatal', self.filepath+"\\bw_frames\\scene.mp4"]
+        self.player = subprocess.Popen(cmd)
 
     # A wrapper method of play_scene, sleep for a provided period of time, capture a frame and check for detail/motion scores.
     def pscc (self, wait_time, parameter):  
         self.play_scene()
         time.sleep(wait_time)
         if (parameter == 'detail'):
-            self.capture_frames()
-            self.check_detail()
+            if self.capture_frames():
+                self.check_detail()
+            elif self.captured: # Keep the scores of the last frame rather than scoring the same "test.png" again. 
+                print("Warning: no new frame, keeping the previous detail scores.")
+            else: # A "test.png" left from an earlier run has nothing to do with this scene. 
+                print("No frame could be captured from the camera, please check the rtsp stream.")
+                sys.exit()
         elif (parameter == 'motion'):
             self.check_motion()
         else:
@@ -197,63 +337,78 @@ class Datapath:
 # The Controller class inherits the Datapath class such that it can invoke the methods defined in Datapath. 
 # It automatically make the scenes. 
 class Controller (Datapath):
-    # Use bisection to get a value of self.fineness that produces a motion object meeting the motion target. 
-    def make_motion (self):
+    # The bisection shared by the methods below. It bisects x between lo and hi until the score is within tol of target. 
+    # build(x) makes the scene for x and checks it, measure() then returns the score it got. increasing tells whether the score grows with x. 
+    # stop, if given, is called after every step and ends the search when it returns True. 
+    # If the target is not met within max_iter steps, the scene that came closest is made again and its x is returned. 
+    def _bisect (self, build, measure, target, tol, lo, hi, increasing = True, stop = None, max_iter = 15):
+        print(f"Initial x1: {lo}, initial x2: {hi}")
+        best_x = None
+        best_error = None
+        for _ in range(max_iter):
+            x = (lo+hi)/2
+            build(x)
+            score = measure()
+            error = abs(score - target)
+            if (best_error is None or error < best_error):
+                best_x, best_error = x, error
+            if (stop is not None and stop()):
+                return x
+            if (error <= tol):
+                return x # Completed. 
+            if ((score < target) == increasing):
+                lo = x
+                print(f"Landed on the left, new x1: {lo}, new x2: {hi}")
+            else:
+                hi = x
+                print(f"Landed on the right, new x1: {lo}, new x2: {hi}")
+        print(f"Target not met in {max_iter} steps, using the closest x: {best_x}")
+        if (best_x != x):
+            build(best_x)
+        return best_x
+
+    # Use bisection to get a motion object size that meets the motion target, within tolerance. 
+    def make_motion (self, tolerance = 0):
         print("Making the motion object")
-        x1 = 0
-        x2 = self.hor_res
-        while True:
-            self.mo_size = (x1+x2)/2 
+        def build (mo_size):
+            self.mo_size = mo_size
             print("New motion object size: ", self.mo_size)
             self.make_scene(mo_size=self.mo_size)
             self.pscc(30.0, 'motion')
             print("motion score: ", self.motion_score)
 
-            if (self.motion_score == self.motion_target):
-                print("motion done! ")
-                break # Completed.
-            elif (self.motion_score > self.motion_target):
-                x2 = self.mo_size 
-            elif (self.motion_score < self.motion_target):
-                x1 = self.mo_size
+        self._bisect(build, lambda: self.motion_score, self.motion_target, tolerance, 0, self.hor_res)
+        print("motion done! ")
             
     # A method to get the desired high detail score by controlling self.fineness. It produces a self.fineness value which gives a high detail score closest to our target. 
-    def hd_delta (self): # Full name: high detail delta
-        delta_i = abs(self.high_detail-self.high_detail_target) # Inital difference between the high detail score and the target
-        print("initil delta: ", delta_i)
-        while True: 
-            self.fineness += 1
-            print("Making new scene with increased fineness.")
-            self.make_scene(mo_size=self.mo_size, fineness=self.fineness, rect1= self.rect1, rect2= self.rect2)
-            self.pscc(5.0, 'detail')
-            delta = abs(self.high_detail-self.high_detail_target) # We increase the fineness by 1, then check the high score again, calculate the new difference. 
-            print("hs: ", self.high_detail)
-            if (delta > delta_i): # The difference either gets bigger or smaller. if it gets bigger, then we are moving away from the optimum fineness as we increase it. We should instead decrease the fineness. 
-                print("We are moving away.")
-                self.direction = -1
-                break
-            elif (delta < delta_i): # If the difference gets smaller, we are moving towards the optimum, we should simply keep increasing fineness. 
-                print("We are moving towards.")
-                self.direction = 1
-                break
-            else:
-                print("new delta equals initial delta, repeat.")
-                continue 
-
-        while True:
-            self.fineness += self.direction
-            print("new fineness: ", self.fineness)
-            previous_delta = delta
-            self.make_scene(mo_size=self.mo_size, fineness=self.fineness, rect1= self.rect1, rect2= self.rect2)
-            self.pscc(5.0, 'detail')
-            delta = abs(self.high_detail-self.high_detail_target) # Make a new scene with the new fineness, compare the delta with the old delta. 
-            print("new delta: {}, new hs: {}".format (delta, self.high_detail))
-            if (delta < previous_delta):
-                continue
-            elif (delta > previous_delta): # Delta should keep decreasing, i.e, we should be keep moving towards the optimum fineness until we observe the first raise. That means we just passed the optimal. 
-                self.fineness += -self.direction # Go one step backwards to get the optimal. 
-                print("optimum fineness: ", self.fineness)
-                break
+    # The difference between the high detail score and the target first decreases then increases with fineness, so we golden-section search the fineness between lo and hi. 
+    def hd_delta (self, lo = 2, hi = 64): # Full name: high detail delta
+        deltas = {} # Fineness -> difference between the high detail score and the target, so that no scene is made twice. 
+        def delta_at (fineness):
+            if fineness not in deltas:
+                self.make_scene(mo_size=self.mo_size, fineness=fineness, rect1= self.rect1, rect2= self.rect2)
+                self.pscc(5.0, 'detail')
+                deltas[fineness] = abs(self.high_detail-self.high_detail_target)
+                print(f"fineness: {fineness}, hs: {self.high_detail}, delta: {deltas[fineness]}")
+            return deltas[fineness]
+
+        ratio = (math.sqrt(5) - 1)/2
+        x2 = lo + round(ratio*(hi - lo))
+        x1 = lo + hi - x2 # Two interior points placed symmetrically, so the one kept is reused in the next round and each round makes only one new scene. 
+        while (hi - lo > 2):
+            if (x1 >= x2): # Rounding can make the points meet on a small bracket, split it in the middle instead. 
+                x1 = lo + (hi - lo)//2
+                x2 = x1 + 1
+            if (delta_at(x1) <= delta_at(x2)): # The optimum cannot be on the right of x2. 
+                hi = x2
+                x2 = x1
+                x1 = lo + hi - x2
+            else: # The optimum cannot be on the left of x1. 
+                lo = x1
+                x1 = x2
+                x2 = lo + hi - x1
+        self.fineness = min(range(lo, hi+1), key=delta_at)
+        print("optimum fineness: ", self.fineness)
     
     # A method that uses bisection to produces self.rect1 and self.rect2 that will meet the low detail target. 
     def ld_rect (self): 
@@ -265,27 +420,21 @@ class Controller (Datapath):
             self.rect2 = self.rects[1]
             self.make_scene(mo_size=self.mo_size, fineness=self.fineness, rect1=self.rect1, rect2=self.rect2) # If rect_num = 1 self.rect2 = {'x':0, 'y':0, 'length':0, 'height':0}
             self.pscc(5.0, 'detail')
-            print("Length1: {}, length2: {}, low score: {}".format(self.lengths[0], self.lengths[1], self.low_detail))
+            print(f"Length1: {self.lengths[0]}, length2: {self.lengths[1]}, low score: {self.low_detail}")
 
         # The bisection algorithm, keep tuning rect1 or rect2 using the algorithm until low detail target is met. 
         def bisection (rect_num):
             rect_num += -1
             x1 = self.poss[rect_num]
             x2 = self.x_limit + rect_num * (self.hor_res - self.x_limit) # if rect_num = 0 (we are bisectioning rect1) then x2 = self.x_limit, if rect_num = 1 (we are bisectioning rect2) then x2 = self.hor_res. 
-            print("Initial x1: {}, initial x2: {}".format(x1, x2))
-            while True:
-                self.lengths[rect_num] = (x2+x1)/2 - self.poss[rect_num]
-                print("New length {}: {}".format(rect_num+1, self.lengths[rect_num]))
+            def build (x):
+                self.lengths[rect_num] = x - self.poss[rect_num]
+                print(f"New length {rect_num+1}: {self.lengths[rect_num]}")
                 tune_rect (rect_num+1)
-                if (self.low_detail < self.low_detail_target - self.tolerance):
-                    x1 = self.lengths[rect_num] + self.poss[rect_num]
-                    print("Landed on the left, new x1: {}, new x2: {}".format(x1, x2))
-                elif (self.low_detail > self.low_detail_target + self.tolerance):
-                    x2 = self.lengths[rect_num] + self.poss[rect_num]
-                    print("Landed on the right, new x1: {}, new x2: {}".format(x1, x2))
-                elif (abs(self.low_detail - self.low_detail_target) <= self.tolerance):
-                    print ('Low detail score furfilled.')
-                    break
+
+            self._bisect(build, lambda: self.low_detail, self.low_detail_target, self.tolerance, x1, x2)
+            if (abs(self.low_detail - self.low_detail_target) <= self.tolerance):
+                print ('Low detail score furfilled.')
 
         self.height = self.ver_res # Rect1 or rect2 width, equals to the vertical resolution. 
         self.box_motion_margin = 100 # The distance between rectangles and the motion object. The two cannot overlap. 
@@ -325,13 +474,10 @@ class Controller (Datapath):
         self.box_motion_margin = 100 
         self.rect1 = {'x':0, 'y':0, 'length':0, 'height':0}
         self.rect2 = {'x':0, 'y':0, 'length':0, 'height':0}
-        print("Making high detail {}% motion.".format(self.motion_target))
+        print(f"Making high detail {self.motion_target}% motion.")
         # We first deal with the motion score. 
         self.make_motion()
         # We then move on to deal with the high detail score. 
-        self.make_scene(mo_size=self.mo_size, fineness=self.fineness)
-        self.pscc(5.0, 'detail')
-
         self.hd_delta()
         self.make_scene(mo_size=self.mo_size, fineness=self.fineness)
         self.pscc(5.0, 'detail')
@@ -356,38 +502,34 @@ class Controller (Datapath):
         self.length_1 = 0
         
         if (not hs_pass):
-            x1 = self.rect1_x_pos
-            x2 = self.x_limit  
-            print("Initial x1: {}, initial x2: {}".format(x1, x2))
-            while True:
-                self.length_1 = (x2+x1)/2 - self.rect1_x_pos
-                print("New length1: {}".format(self.length_1))
+            def build (x):
+                self.length_1 = x - self.rect1_x_pos
+                print(f"New length1: {self.length_1}")
                 self.rect1 = {'x':self.rect1_x_pos, 'y':0, 'length':self.length_1, 'height':self.height}
                 self.make_scene(mo_size=self.mo_size, fineness=self.fineness, rect1=self.rect1)
                 self.pscc(5.0, 'detail')
-                print("Length 1: {}, high score: {}, low score: {}".format(self.length_1, self.high_detail, self.low_detail))
+                print(f"Length 1: {self.length_1}, high score: {self.high_detail}, low score: {self.low_detail}")
+
+            def low_detail_exceeded ():
                 if (self.low_detail >= self.low_detail_target):
                     print("Cannot make high detail scene...low detail exceeds the limit, please manually make it using Datapath.")
-                    break
-                elif (self.high_detail < self.high_detail_target - self.tolerance): # Too much low detail, shrink the box 
-                    x2 = self.length_1 + self.rect1_x_pos
-                    print("Landed on the left, new x1: {}, new x2: {}".format(x1, x2))
-                elif (self.high_detail > self.high_detail_target + self.tolerance):
-                    x1 = self.length_1 + self.rect1_x_pos
-                    print("Landed on the right, new x1: {}, new x2: {}".format(x1, x2))
-                elif (abs(self.high_detail - self.high_detail_target) <= self.tolerance):
-                    print ('high detail score furfilled.')
-                    break   
+                    return True
+                return False
+
+            # A bigger box means less high detail. 
+            self._bisect(build, lambda: self.high_detail, self.high_detail_target, self.tolerance, self.rect1_x_pos, self.x_limit, increasing=False, stop=low_detail_exceeded)
+            if (abs(self.high_detail - self.high_detail_target) <= self.tolerance and self.low_detail < self.low_detail_target):
+                print ('high detail score furfilled.')
         
-        print("High detail {}% is done, motion score: {}, high detail score: {}, low detail score: {}".format(str(self.motion_target), self.motion_score, self.high_detail, self.low_detail))
-        self.make_scene(mo_size=self.mo_size, fineness=self.fineness, rect1=self.rect1, name = 'high_{}%'.format(self.motion_target))
+        print(f"High detail {self.motion_target}% is done, motion score: {self.motion_score}, high detail score: {self.high_detail}, low detail score: {self.low_detail}")
+        self.make_scene(mo_size=self.mo_size, fineness=self.fineness, rect1=self.rect1, name = f'high_{self.motion_target}%')
     
     # This method makes the low detail scenes. Motion target can be 5 or 1.
     def low_detail_scenes (self, motion_target): 
         self.high_detail_target = 30
         self.low_detail_target = 60
         self.motion_target = motion_target
-        print("Making low detail {}% motion.".format(self.motion_target))
+        print(f"Making low detail {self.motion_target}% motion.")
 
         # We first deal with the motion score. 
         self.make_motion()
@@ -398,7 +540,7 @@ class Controller (Datapath):
         self.pscc(5.0, 'detail')
         while True:
             self.pscc(5.0, 'detail')
-            print("hs: {}, ls: {}".format(self.high_detail, self.low_detail))
+            print(f"hs: {self.high_detail}, ls: {self.low_detail}")
             if (self.high_detail >= self.high_detail_target):
                 self.fineness += 1 
                 self.make_scene(mo_size=self.mo_size, fineness=self.fineness)
@@ -410,16 +552,16 @@ class Controller (Datapath):
         # Once we make sure high detail score will remain below the limit, we draw the low detail boxes. 
         self.ld_rect()
 
-        self.make_scene(mo_size=self.mo_size, fineness=self.fineness, rect1=self.rect1, rect2=self.rect2, name = 'low_{}%'.format(self.motion_target))
+        self.make_scene(mo_size=self.mo_size, fineness=self.fineness, rect1=self.rect1, rect2=self.rect2, name = f'low_{self.motion_target}%')
 
-        print("Low detail {}% is done, motion score: {}, high detail score: {}, low detail score: {}".format(str(self.motion_target), self.motion_score, self.high_detail, self.low_detail))
+        print(f"Low detail {self.motion_target}% is done, motion score: {self.motion_score}, high detail score: {self.high_detail}, low detail score: {self.low_detail}")
 
     # This method makes the medium detail scenes. Motion target can be 5 or 1.
     def medium_detail_scenes (self, motion_target):
         self.high_detail_target = 30
         self.low_detail_target = 30
         self.motion_target = motion_target
-        print("Making medium detail {}% motion.".format(self.motion_target))
+        print(f"Making medium detail {self.motion_target}% motion.")
 
         self.make_motion()
 
@@ -428,10 +570,10 @@ class Controller (Datapath):
         
         self.hd_delta()
 
-        self.make_scene(mo_size=self.mo_size, fineness=self.fineness, rect1=self.rect1, rect2=self.rect2, name = 'medium_{}%'.format(self.motion_target))
+        self.make_scene(mo_size=self.mo_size, fineness=self.fineness, rect1=self.rect1, rect2=self.rect2, name = f'medium_{self.motion_target}%')
 
         self.pscc(5.0, 'detail')
-        print("Medium detail {}% is done, motion score: {}, high detail score: {}, low detail score: {}".format(str(self.motion_target), self.motion_score, self.high_detail, self.low_detail))
+        print(f"Medium detail {self.motion_target}% is done, motion score: {self.motion_score}, high detail score: {self.high_detail}, low detail score: {self.low_detail}")
 
 def main ():
     # Illustration of making the scenes automatically using the Controller methods. 